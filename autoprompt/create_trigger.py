@@ -39,9 +39,13 @@ class PredictWrapper:
     """
     PyTorch transformers model wrapper. Handles necc. preprocessing of inputs for triggers
     experiments.
+
+    Set `compiled` if the model is wrapped by `torch.compile`. The batch dimension is then hinted
+    as dynamic, so the different batch sizes seen while scoring do not each trigger a recompile.
     """
-    def __init__(self, model):
+    def __init__(self, model, compiled=False):
         self._model = model
+        self._compiled = compiled
 
     def __call__(self, model_inputs, trigger_ids):
         # Copy dict so pop operations don't have unwanted side-effects
@@ -49,10 +53,15 @@ class PredictWrapper:
         trigger_mask = model_inputs.pop('trigger_mask')
         predict_mask = model_inputs.pop('predict_mask')
         model_inputs = replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask)
+        if self._compiled:
+            for v in model_inputs.values():
+                torch._dynamo.maybe_mark_dynamic(v, 0)
         # logits, *_ = self._model(**model_inputs)
         # The above statement does not work with higher transfromers lib. Chagned wth the statement below
         logits = self._model(**model_inputs).logits
-        predict_logits = logits.masked_select(predict_mask.unsqueeze(-1)).view(logits.size(0), -1)
+        # Index rows with the (B, L) mask rather than broadcasting it over the full (B, L, V)
+        # logits, so only the predict positions are read.
+        predict_logits = logits[predict_mask].view(logits.size(0), -1)
         return predict_logits
 
 
@@ -64,43 +73,47 @@ class AccuracyFn:
     one of the label logps we know we are accurate.
     """
     def __init__(self, tokenizer, label_map, device, tokenize_labels=False):
-        self._all_label_ids = []
+        all_label_ids = []
         self._pred_to_label = []
         logger.info(label_map)
         for label, label_tokens in label_map.items():
-            self._all_label_ids.append(utils.encode_label(tokenizer, label_tokens, tokenize_labels).to(device))
+            all_label_ids.append(utils.encode_label(tokenizer, label_tokens, tokenize_labels))
             self._pred_to_label.append(label)
+        # Pad label ids into a single (num_labels, max_label_len) tensor that lives on the device,
+        # so every label can be scored with one gather.
+        self._all_label_ids = utils.pad_squeeze_sequence(
+            all_label_ids,
+            batch_first=True,
+            padding_value=0
+        ).to(device)
         logger.info(self._all_label_ids)
 
+    def _all_label_scores(self, predict_logits):
+        """Returns the (unnormalized) scores of every label, shape: (batch_size, num_labels)."""
+        bsz = predict_logits.size(0)
+        num_labels = self._all_label_ids.size(0)
+        return get_label_scores(
+            predict_logits.unsqueeze(1).expand(-1, num_labels, -1),
+            self._all_label_ids.expand(bsz, -1, -1)
+        )
+
     def __call__(self, predict_logits, gold_label_ids):
-        # Get total log-probability for the true label
-        gold_logp = get_loss(predict_logits, gold_label_ids)
+        # Get total (unnormalized) score for the true label
+        gold_score = get_label_scores(predict_logits, gold_label_ids)
 
-        # Get total log-probability for all labels
-        bsz = predict_logits.size(0)
-        all_label_logp = []
-        for label_ids in self._all_label_ids:
-            label_logp = get_loss(predict_logits, label_ids.repeat(bsz, 1))
-            all_label_logp.append(label_logp)
-        all_label_logp = torch.stack(all_label_logp, dim=-1)
-        _, predictions = all_label_logp.max(dim=-1)
-        predictions = [self._pred_to_label[x] for x in predictions.tolist()]
+        # Get total (unnormalized) score for all labels
+        all_label_scores = self._all_label_scores(predict_logits)
 
-        # Add up the number of entries where loss is greater than or equal to gold_logp.
-        ge_count = all_label_logp.le(gold_logp.unsqueeze(-1)).sum(-1)
+        # Add up the number of entries where score is greater than or equal to gold_score.
+        ge_count = all_label_scores.ge(gold_score.unsqueeze(-1)).sum(-1)
         correct = ge_count.le(1)  # less than in case of num. prec. issues
 
         return correct.float()
 
     # TODO: @rloganiv - This is hacky. Replace with something sensible.
     def predict(self, predict_logits):
-        bsz = predict_logits.size(0)
-        all_label_logp = []
-        for label_ids in self._all_label_ids:
-            label_logp = get_loss(predict_logits, label_ids.repeat(bsz, 1))
-            all_label_logp.append(label_logp)
-        all_label_logp = torch.stack(all_label_logp, dim=-1)
-        _, predictions = all_label_logp.max(dim=-1)
+        all_label_scores = self._all_label_scores(predict_logits)
+        _, predictions = all_label_scores.max(dim=-1)
         predictions = [self._pred_to_label[x] for x in predictions.tolist()]
         return predictions
 
@@ -154,18 +167,61 @@ def hotflip_attack(averaged_grad,
 
 
 def replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask):
-    """Replaces the trigger tokens in input_ids."""
+    """
+    Replaces the trigger tokens in input_ids. `trigger_ids` either holds a single trigger shared by
+    the whole batch, or one trigger per instance.
+    """
     out = model_inputs.copy()
+    num_trigger_tokens = trigger_ids.size(-1)
+    # Nothing to replace if the template has no trigger tokens.
+    if num_trigger_tokens == 0:
+        return out
     input_ids = model_inputs['input_ids']
-    trigger_ids = trigger_ids.repeat(trigger_mask.size(0), 1)
-    try:
-        filled = input_ids.masked_scatter(trigger_mask, trigger_ids)
-    except RuntimeError:
-        filled = input_ids
-    out['input_ids'] = filled
+    # The i'th trigger position in each instance takes the i'th trigger token. Broadcasting the
+    # trigger across the batch with `expand` avoids materializing a copy per instance.
+    trigger_ids = trigger_ids.expand(trigger_mask.size(0), -1)
+    trigger_positions = trigger_mask.long().cumsum(dim=-1)
+    # Instances with more trigger positions than trigger tokens are left as is. This is checked
+    # on the device, to avoid a host sync on every forward pass.
+    valid = trigger_positions[:, -1:].le(num_trigger_tokens)
+    trigger_positions = trigger_positions.sub_(1).clamp_(0, num_trigger_tokens - 1)
+    out['input_ids'] = torch.where(
+        trigger_mask & valid,
+        trigger_ids.gather(1, trigger_positions),
+        input_ids
+    )
     return out
 
 
+def score_triggers(predictor, evaluation_fn, model_inputs, labels, triggers, chunk_size):
+    """
+    Returns the evaluation metric of each trigger summed over the batch, shape: (num_triggers,).
+
+    Triggers are scored in chunks of `chunk_size`. The batch is tiled once per trigger in the chunk,
+    so the whole chunk is scored in a single forward pass.
+    """
+    bsz = labels.size(0)
+    scores = []
+    for i in range(0, triggers.size(0), chunk_size):
+        trigger_chunk = triggers[i:i + chunk_size]
+        num_chunk = trigger_chunk.size(0)
+        if num_chunk == 1:
+            # No tiling needed, so avoid copying the batch.
+            tiled_inputs = model_inputs
+            tiled_triggers = trigger_chunk.expand(bsz, -1)
+            tiled_labels = labels
+        else:
+            # Row k * bsz + j of the tiled batch holds instance j paired with trigger k.
+            tiled_inputs = {k: v.repeat(num_chunk, 1) for k, v in model_inputs.items()}
+            tiled_triggers = trigger_chunk.repeat_interleave(bsz, dim=0)
+            tiled_labels = labels.repeat(num_chunk, 1)
+        with torch.no_grad():
+            predict_logits = predictor(tiled_inputs, tiled_triggers)
+            eval_metric = evaluation_fn(predict_logits, tiled_labels)
+        scores.append(eval_metric.view(num_chunk, bsz).sum(dim=-1))
+    return torch.cat(scores)
+
+
 def get_loss(predict_logits, label_ids):
     predict_logp = F.log_softmax(predict_logits, dim=-1)
     target_logp = predict_logp.gather(-1, label_ids)
@@ -174,6 +230,17 @@ def get_loss(predict_logits, label_ids):
     return -target_logp
 
 
+def get_label_scores(predict_logits, label_ids):
+    """
+    Unnormalized counterpart of `-get_loss`. The log-partition function is shared by every label,
+    so when labels are only compared against each other we can skip the full-vocabulary softmax
+    and just look at the label logits.
+    """
+    target_logits = predict_logits.gather(-1, label_ids)
+    target_logits = target_logits - 1e32 * label_ids.eq(0)  # Apply mask
+    return torch.logsumexp(target_logits, dim=-1)
+
+
 def isupper(idx, tokenizer):
     """
     Determines whether a token (e.g., word piece) begins with a capital letter.
@@ -201,9 +268,22 @@ def run_model(args):
     logger.info('Loading model, tokenizer, etc.')
     config, model, tokenizer = load_pretrained(args.model_name)
     model.to(device)
+    utils.remove_dropout(model)  # The model is only ever used in eval mode
     embeddings = get_embeddings(model, config)
+    # We only need gradients w.r.t. the embedding outputs, so skip computing weight gradients for
+    # the rest of the model. The word embeddings still need to require grad, otherwise their
+    # outputs would not be part of the autograd graph.
+    model.requires_grad_(False)
+    embeddings.weight.requires_grad_(True)
     embedding_gradient = GradientStorage(embeddings)
     predictor = PredictWrapper(model)
+    if args.compile:
+        # NOTE: Gradients w.r.t. the trigger embeddings are collected using a backward hook, so we
+        # only use the compiled model for the (no grad) scoring passes.
+        compiled_model = torch.compile(model, mode='reduce-overhead')
+        eval_predictor = PredictWrapper(compiled_model, compiled=True)
+    else:
+        eval_predictor = predictor
 
     if args.label_map is not None:
         label_map = json.loads(args.label_map)
@@ -243,7 +323,12 @@ def run_model(args):
         evaluation_fn = lambda x, y: -get_loss(x, y)
 
     logger.info('Loading datasets')
-    collator = utils.Collator(pad_token_id=tokenizer.pad_token_id)
+    # Bucket sequence lengths so the compiled model does not need to recompile for every length.
+    collator = utils.Collator(
+        pad_token_id=tokenizer.pad_token_id,
+        pad_to_multiple_of=32 if args.compile else None,
+        pin_memory=device.type == 'cuda'
+    )
 
     if args.perturbed:
         train_dataset = utils.load_augmented_trigger_dataset(args.train, templatizer, limit=args.limit)
@@ -282,16 +367,16 @@ def run_model(args):
                 filter[idx] = -1e32
 
     logger.info('Evaluating')
-    numerator = 0
+    numerator = torch.zeros((), device=device)
     denominator = 0
     for model_inputs, labels in tqdm(dev_loader):
-        model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-        labels = labels.to(device)
+        model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+        labels = labels.to(device, non_blocking=True)
         with torch.no_grad():
-            predict_logits = predictor(model_inputs, trigger_ids)
-        numerator += evaluation_fn(predict_logits, labels).sum().item()
+            predict_logits = eval_predictor(model_inputs, trigger_ids)
+        numerator += evaluation_fn(predict_logits, labels).sum()
         denominator += labels.size(0)
-    dev_metric = numerator / (denominator + 1e-13)
+    dev_metric = numerator.item() / (denominator + 1e-13)
     logger.info(f'Dev metric: {dev_metric}')
 
     best_dev_metric = -float('inf')
@@ -303,7 +388,7 @@ def run_model(args):
         logger.info(f'Iteration: {i}')
 
         logger.info('Accumulating Gradient')
-        model.zero_grad()
+        model.zero_grad(set_to_none=True)
 
         pbar = tqdm(range(args.accumulation_steps))
         train_iter = iter(train_loader)
@@ -321,8 +406,8 @@ def run_model(args):
                     'Effective batch size will be smaller than specified.'
                 )
                 break
-            model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-            labels = labels.to(device)
+            model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            labels = labels.to(device, non_blocking=True)
             predict_logits = predictor(model_inputs, trigger_ids)
             loss = get_loss(predict_logits, labels).mean()
             loss.backward()
@@ -349,8 +434,12 @@ def run_model(args):
                                     num_candidates=args.num_cand,
                                     filter=filter)
 
-        current_score = 0
-        candidate_scores = torch.zeros(args.num_cand, device=device)
+        # The current trigger is scored alongside the candidates, so that a single tensor
+        # accumulates all of the scores: index 0 holds the current trigger's score, the rest
+        # hold the candidates' scores.
+        all_triggers = trigger_ids.repeat(args.num_cand + 1, 1)
+        all_triggers[1:, token_to_flip] = candidates
+        scores = torch.zeros(args.num_cand + 1, device=device)
         denom = 0
         for step in pbar:
 
@@ -362,31 +451,22 @@ def run_model(args):
                     'Effective batch size will be smaller than specified.'
                 )
                 break
-            model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-            labels = labels.to(device)
-            with torch.no_grad():
-                predict_logits = predictor(model_inputs, trigger_ids)
-                eval_metric = evaluation_fn(predict_logits, labels)
-
-            # Update current score
-            current_score += eval_metric.sum()
+            model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            labels = labels.to(device, non_blocking=True)
             denom += labels.size(0)
 
             # NOTE: Instead of iterating over tokens to flip we randomly change just one each
             # time so the gradients don't get stale.
-            for i, candidate in enumerate(candidates):
+            scores += score_triggers(
+                eval_predictor,
+                evaluation_fn,
+                model_inputs,
+                labels,
+                all_triggers,
+                args.cand_batch_size
+            )
 
-                # if candidate.item() in filter_candidates:
-                #     candidate_scores[i] = -1e32
-                #     continue
-
-                temp_trigger = trigger_ids.clone()
-                temp_trigger[:, token_to_flip] = candidate
-                with torch.no_grad():
-                    predict_logits = predictor(model_inputs, temp_trigger)
-                    eval_metric = evaluation_fn(predict_logits, labels)
-
-                candidate_scores[i] += eval_metric.sum()
+        current_score, candidate_scores = scores[0], scores[1:]
 
         # TODO: Something cleaner. LAMA templates can't have mask tokens, so if
         # there are still mask tokens in the trigger then set the current score
@@ -406,16 +486,16 @@ def run_model(args):
             continue
 
         logger.info('Evaluating')
-        numerator = 0
+        numerator = torch.zeros((), device=device)
         denominator = 0
         for model_inputs, labels in tqdm(dev_loader):
-            model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-            labels = labels.to(device)
+            model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            labels = labels.to(device, non_blocking=True)
             with torch.no_grad():
-                predict_logits = predictor(model_inputs, trigger_ids)
-            numerator += evaluation_fn(predict_logits, labels).sum().item()
+                predict_logits = eval_predictor(model_inputs, trigger_ids)
+            numerator += evaluation_fn(predict_logits, labels).sum()
             denominator += labels.size(0)
-        dev_metric = numerator / (denominator + 1e-13)
+        dev_metric = numerator.item() / (denominator + 1e-13)
 
         logger.info(f'Trigger tokens: {tokenizer.convert_ids_to_tokens(trigger_ids.squeeze(0))}')
         logger.info(f'Dev metric: {dev_metric}')
@@ -511,8 +591,13 @@ if __name__ == '__main__':
                         help='Perturbed sentence evaluation of relation extraction: replace each object in dataset with a random other object')
     parser.add_argument('--patience', type=int, default=5)
     parser.add_argument('--num-cand', type=int, default=10)
+    parser.add_argument('--cand-batch-size', type=int, default=1,
+                        help='Number of candidate triggers scored per forward pass')
     parser.add_argument('--sentence-size', type=int, default=50)
 
+    parser.add_argument('--compile', action='store_true',
+                        help='Use `torch.compile` for scoring triggers on the train and dev sets.')
+
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
 
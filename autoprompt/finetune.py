@@ -13,11 +13,10 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
+from torch.optim import AdamW
 from torch.optim.lr_scheduler import LambdaLR
 import transformers
-from transformers import (
-    AdamW, AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
-)
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
 from tqdm import tqdm
 
 import autoprompt.utils as utils
@@ -26,6 +25,12 @@ import autoprompt.utils as utils
 logger = logging.getLogger(__name__)
 
 
+AMP_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
 def set_seed(seed: int):
     """Sets the relevant random seeds."""
     random.seed(seed)
@@ -61,7 +66,10 @@ def main(args):
     model = AutoModelForSequenceClassification.from_pretrained(args.model_name, config=config)
     model.to(device)
 
-    collator = utils.Collator(pad_token_id=tokenizer.pad_token_id)
+    collator = utils.Collator(
+        pad_token_id=tokenizer.pad_token_id,
+        pin_memory=device.type == 'cuda'
+    )
     train_dataset, label_map = utils.load_classification_dataset(
         args.train,
         tokenizer,
@@ -95,13 +103,22 @@ def main(args):
     else:
         betas = (0.0, 0.000)
 
+    # NOTE: eps matches the default of the (deprecated) `transformers.AdamW` we used to use.
     optimizer = AdamW(
         model.parameters(),
         lr=args.lr,
         weight_decay=1e-2,
-        betas=betas
+        betas=betas,
+        eps=1e-6,
+        fused=device.type == 'cuda'
     )
 
+    # Mixed precision. Weights stay in fp32, autocast handles casting on the fly. Loss scaling is
+    # only needed for fp16, bf16 has the same exponent range as fp32.
+    amp_enabled = args.precision in AMP_DTYPES
+    amp_dtype = AMP_DTYPES.get(args.precision)
+    scaler = torch.amp.GradScaler('cuda', enabled=args.precision == 'fp16')
+
     # Use suggested learning rate scheduler
     num_training_steps = len(train_dataset) * args.epochs // args.bsz
     num_warmup_steps = num_training_steps // 10
@@ -114,6 +131,7 @@ def main(args):
     elif not args.force_overwrite:
         raise RuntimeError('Checkpoint directory already exists.')
 
+    checkpointer = utils.AsyncCheckpointer()
     try:
         best_accuracy = 0
         for epoch in range(args.epochs):
@@ -122,13 +140,15 @@ def main(args):
             avg_loss = utils.ExponentialMovingAverage()
             pbar = tqdm(train_loader)
             for model_inputs, labels in pbar:
-                model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-                labels = labels.to(device)
-                optimizer.zero_grad()
-                logits, *_ = model(**model_inputs)
-                loss = F.cross_entropy(logits, labels.squeeze(-1))
-                loss.backward()
-                optimizer.step()
+                model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+                labels = labels.to(device, non_blocking=True)
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_enabled):
+                    logits, *_ = model(**model_inputs)
+                    loss = F.cross_entropy(logits, labels.squeeze(-1))
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()
                 avg_loss.update(loss.item())
                 pbar.set_description(f'loss: {avg_loss.get_metric(): 0.4f}, '
@@ -136,40 +156,42 @@ def main(args):
 
             logger.info('Evaluating...')
             model.eval()
-            correct = 0
+            correct = torch.zeros((), dtype=torch.long, device=device)
             total = 0
-            with torch.no_grad():
+            with torch.no_grad(), torch.autocast(device.type, dtype=amp_dtype, enabled=amp_enabled):
                 for model_inputs, labels in dev_loader:
-                    model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-                    labels = labels.to(device)
+                    model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+                    labels = labels.to(device, non_blocking=True)
                     logits, *_ = model(**model_inputs)
                     _, preds = logits.max(dim=-1)
-                    correct += (preds == labels.squeeze(-1)).sum().item()
+                    correct += (preds == labels.squeeze(-1)).sum()
                     total += labels.size(0)
-                accuracy = correct / (total + 1e-13)
+                accuracy = correct.item() / (total + 1e-13)
             logger.info(f'Accuracy: {accuracy : 0.4f}')
 
             if accuracy > best_accuracy:
                 logger.info('Best performance so far.')
-                model.save_pretrained(args.ckpt_dir)
+                checkpointer.save(model, args.ckpt_dir)
                 tokenizer.save_pretrained(args.ckpt_dir)
                 best_accuracy = accuracy
     except KeyboardInterrupt:
         logger.info('Interrupted...')
+    finally:
+        checkpointer.close()
 
     logger.info('Testing...')
     model.eval()
-    correct = 0
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
-    with torch.no_grad():
+    with torch.no_grad(), torch.autocast(device.type, dtype=amp_dtype, enabled=amp_enabled):
         for model_inputs, labels in test_loader:
-            model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-            labels = labels.to(device)
+            model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            labels = labels.to(device, non_blocking=True)
             logits, *_ = model(**model_inputs)
             _, preds = logits.max(dim=-1)
-            correct += (preds == labels.squeeze(-1)).sum().item()
+            correct += (preds == labels.squeeze(-1)).sum()
             total += labels.size(0)
-        accuracy = correct / (total + 1e-13)
+        accuracy = correct.item() / (total + 1e-13)
     logger.info(f'Accuracy: {accuracy : 0.4f}')
 
 
@@ -190,6 +212,8 @@ if __name__ == '__main__':
     parser.add_argument('--limit', type=int, default=None)
     parser.add_argument('--seed', type=int, default=1234)
     parser.add_argument('--bias-correction', action='store_true')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='Precision used for forward/backward passes. fp16 and bf16 use autocast.')
     parser.add_argument('-f', '--force-overwrite', action='store_true')
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
@@ -61,6 +61,7 @@ def main(args):
     logger.info('Loading model, tokenizer, etc.')
     config, model, tokenizer = load_pretrained(args.model_name)
     model.to(device)
+    utils.remove_dropout(model)  # The model is only ever used in eval mode
     final_embeddings = get_final_embeddings(model)
     embedding_storage = utils.OutputStorage(final_embeddings)
     word_embeddings = get_word_embeddings(model)
@@ -93,7 +94,10 @@ def main(args):
     trigger_ids = torch.tensor(trigger_ids, device=device).unsqueeze(0)
 
     logger.info('Loading datasets')
-    collator = utils.Collator(pad_token_id=tokenizer.pad_token_id)
+    collator = utils.Collator(
+        pad_token_id=tokenizer.pad_token_id,
+        pin_memory=device.type == 'cuda'
+    )
     train_dataset = utils.load_trigger_dataset(args.train, templatizer, args.use_ctx)
     train_loader = DataLoader(train_dataset, batch_size=args.bsz, shuffle=True, collate_fn=collator)
 
@@ -110,16 +114,16 @@ def main(args):
     for i in range(args.iters):
         pbar = tqdm(train_loader)
         for model_inputs, labels in pbar:
-            optimizer.zero_grad()
-            model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-            labels = labels.to(device)
+            optimizer.zero_grad(set_to_none=True)
+            model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+            labels = labels.to(device, non_blocking=True)
             trigger_mask = model_inputs.pop('trigger_mask')
             predict_mask = model_inputs.pop('predict_mask')
             model_inputs = ct.replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask)
             with torch.no_grad():
                 model(**model_inputs)
             embeddings = embedding_storage.get()
-            predict_embeddings = embeddings.masked_select(predict_mask.unsqueeze(-1)).view(embeddings.size(0), -1)
+            predict_embeddings = embeddings[predict_mask].view(embeddings.size(0), -1)
             logits = projection(predict_embeddings)
             loss = F.cross_entropy(logits, labels.squeeze(-1))
             loss.backward()
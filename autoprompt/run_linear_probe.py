@@ -27,8 +27,12 @@ def main(args):
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     model = AutoPopsicle.from_pretrained(args.model_name, config=config)
     model.to(device)
+    utils.remove_dropout(model)  # The model is only ever used in eval mode
 
-    collator = utils.Collator(pad_token_id=tokenizer.pad_token_id)
+    collator = utils.Collator(
+        pad_token_id=tokenizer.pad_token_id,
+        pin_memory=device.type == 'cuda'
+    )
     train_dataset, label_map = utils.load_classification_dataset(
         args.train,
         tokenizer,
@@ -45,7 +49,7 @@ def main(args):
         args.label_field,
         label_map
     )
-    dev_loader = DataLoader(dev_dataset, batch_size=args.bsz, shuffle=True, collate_fn=collator)
+    dev_loader = DataLoader(dev_dataset, batch_size=args.bsz, shuffle=False, collate_fn=collator)
     test_dataset, _ = utils.load_classification_dataset(
         args.test,
         tokenizer,
@@ -54,7 +58,7 @@ def main(args):
         args.label_field,
         label_map
     )
-    test_loader = DataLoader(test_dataset, batch_size=args.bsz, shuffle=True, collate_fn=collator)
+    test_loader = DataLoader(test_dataset, batch_size=args.bsz, shuffle=False, collate_fn=collator)
     optimizer = torch.optim.Adam(model.classifier.parameters(), lr=args.lr, weight_decay=1e-6)
 
     if not args.ckpt_dir.exists():
@@ -63,6 +67,7 @@ def main(args):
     elif not args.force_overwrite:
         raise RuntimeError('Checkpoint directory already exists.')
 
+    checkpointer = utils.AsyncCheckpointer()
     best_accuracy = 0
     try:
         for epoch in range(args.epochs):
@@ -71,9 +76,9 @@ def main(args):
             avg_loss = utils.ExponentialMovingAverage()
             pbar = tqdm(train_loader)
             for model_inputs, labels in pbar:
-                model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-                labels = labels.to(device)
-                optimizer.zero_grad()
+                model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+                labels = labels.to(device, non_blocking=True)
+                optimizer.zero_grad(set_to_none=True)
                 logits, *_ = model(**model_inputs)
                 loss = F.cross_entropy(logits, labels.squeeze(-1))
                 loss.backward()
@@ -83,43 +88,45 @@ def main(args):
 
             logger.info('Evaluating...')
             model.eval()
-            correct = 0
+            correct = torch.zeros((), dtype=torch.long, device=device)
             total = 0
             for model_inputs, labels in dev_loader:
-                model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-                labels = labels.to(device)
+                model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+                labels = labels.to(device, non_blocking=True)
                 logits, *_ = model(**model_inputs)
                 _, preds = logits.max(dim=-1)
-                correct += (preds == labels.squeeze(-1)).sum().item()
+                correct += (preds == labels.squeeze(-1)).sum()
                 total += labels.size(0)
-            accuracy = correct / (total + 1e-13)
+            accuracy = correct.item() / (total + 1e-13)
             logger.info(f'Accuracy: {accuracy : 0.4f}')
 
             if accuracy > best_accuracy:
                 logger.info('Best performance so far. Saving...')
                 # torch.save(model.state_dict(), args.ckpt_dir / WEIGHTS_NAME)
                 # model.config.to_json_file(args.ckpt_dir / CONFIG_NAME)
-                model.save_pretrained(args.ckpt_dir)
+                checkpointer.save(model, args.ckpt_dir)
                 tokenizer.save_pretrained(args.ckpt_dir)
                 best_accuracy = accuracy
 
     except KeyboardInterrupt:
         logger.info('Training manually terminated.')
+    finally:
+        checkpointer.close()
 
     logger.info('Testing...')
     checkpoint = torch.load(args.ckpt_dir / WEIGHTS_NAME)
     model.load_state_dict(checkpoint)
     model.eval()
-    correct = 0
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
     for model_inputs, labels in test_loader:
-        model_inputs = {k: v.to(device) for k, v in model_inputs.items()}
-        labels = labels.to(device)
+        model_inputs = {k: v.to(device, non_blocking=True) for k, v in model_inputs.items()}
+        labels = labels.to(device, non_blocking=True)
         logits, *_ = model(**model_inputs)
         _, preds = logits.max(dim=-1)
-        correct += (preds == labels.squeeze(-1)).sum().item()
+        correct += (preds == labels.squeeze(-1)).sum()
         total += labels.size(0)
-    accuracy = correct / (total + 1e-13)
+    accuracy = correct.item() / (total + 1e-13)
     logger.info(f'Accuracy: {accuracy : 0.4f}')
 
 
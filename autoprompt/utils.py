@@ -1,13 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import copy
 import json
 import logging
 from multiprocessing.sharedctypes import Value
+from pathlib import Path
 import random
 from collections import defaultdict
 
 import torch
 from torch.nn.utils.rnn import pad_sequence
+from transformers import WEIGHTS_NAME
 
 
 MAX_CONTEXT_LEN = 50
@@ -57,9 +60,23 @@ class ExponentialMovingAverage:
 class Collator:
     """
     Collates transformer outputs.
+
+    Parameters
+    ==========
+    pad_token_id : int
+        The id used to pad input_ids. Default: 0.
+    pad_to_multiple_of : int
+        If specified, sequence lengths are padded up to a multiple of this value. Keeps the number
+        of distinct input shapes small, which avoids recompilation when using `torch.compile`.
+        Default: None.
+    pin_memory : bool
+        Whether to collate directly into page-locked memory, so batches can be copied to the GPU
+        with `non_blocking=True` without an extra pinning copy. Default: False.
     """
-    def __init__(self, pad_token_id=0):
+    def __init__(self, pad_token_id=0, pad_to_multiple_of=None, pin_memory=False):
         self._pad_token_id = pad_token_id
+        self._pad_to_multiple_of = pad_to_multiple_of
+        self._pin_memory = pin_memory
 
     def __call__(self, features):
         # Separate the list of inputs and labels
@@ -73,13 +90,83 @@ class Collator:
                 padding_value = self._pad_token_id
             else:
                 padding_value = 0
-            # NOTE: We need to squeeze to get rid of fake batch dim.
             sequence = [x[key] for x in model_inputs]
-            padded = pad_squeeze_sequence(sequence, batch_first=True, padding_value=padding_value)
-            padded_inputs[key] = padded
-        labels = pad_squeeze_sequence(labels, batch_first=True, padding_value=0)
+            padded_inputs[key] = self._pad(sequence, padding_value, self._pad_to_multiple_of)
+        labels = self._pad(labels, padding_value=0)
         return padded_inputs, labels
 
+    def _pad(self, sequence, padding_value, pad_to_multiple_of=None):
+        """Pads the sequence into a single freshly allocated (and optionally pinned) tensor."""
+        # NOTE: We need to squeeze to get rid of fake batch dim.
+        sequence = [x.squeeze(0) for x in sequence]
+        max_len = max(x.size(0) for x in sequence)
+        if pad_to_multiple_of is not None:
+            max_len += -max_len % pad_to_multiple_of
+        padded = torch.full(
+            (len(sequence), max_len),
+            padding_value,
+            dtype=sequence[0].dtype,
+            pin_memory=self._pin_memory
+        )
+        for i, x in enumerate(sequence):
+            padded[i, :x.size(0)] = x
+        return padded
+
+
+def remove_dropout(model):
+    """
+    Replaces every dropout module in the model with an identity. Only meant for models that are
+    never put in training mode, where dropout is a no-op that still costs a module call per layer.
+    """
+    for module in model.modules():
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Dropout):
+                setattr(module, name, torch.nn.Identity())
+
+
+def cpu_state_dict(model):
+    """
+    Returns a copy of the model's state dict on the CPU. Since it does not share storage with the
+    model, it can be serialized in a background thread while training keeps updating the model.
+    """
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+
+class AsyncCheckpointer:
+    """
+    Writes model checkpoints in a background thread, so training does not block on disk I/O. The
+    checkpoint layout matches `save_pretrained`: the config plus the weights in `WEIGHTS_NAME`. At
+    most one save is in flight at a time. Call `close()` once done, to wait for the last save and
+    surface any error it raised.
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, model, save_directory):
+        # Copy the weights synchronously, so training cannot modify them while they are written.
+        state_dict = cpu_state_dict(model)
+        self.wait()
+        # The config is tiny, so write it right away.
+        model.config.save_pretrained(save_directory)
+        self._pending = self._executor.submit(
+            torch.save,
+            state_dict,
+            Path(save_directory) / WEIGHTS_NAME
+        )
+
+    def wait(self):
+        """Blocks until the pending save (if any) has finished, re-raising its error."""
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
 
 def encode_label(tokenizer, label, tokenize=False):
     """
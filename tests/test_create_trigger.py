@@ -61,3 +61,127 @@ def test_replace_trigger_tokens():
         [1, 5, 1, 6]
     ])
     assert torch.equal(expected, replaced['input_ids'])
+
+
+def test_replace_trigger_tokens_per_instance():
+    model_inputs = {
+        'input_ids': torch.tensor([
+            [1, 2, 3, 4],
+            [1, 1, 1, 0]
+        ])
+    }
+    trigger_ids = torch.tensor([
+        [5, 6],
+        [7, 8]
+    ])
+    trigger_mask = torch.tensor([
+            [True, True, False, False],
+            [False, True, False, True]
+    ])
+    replaced = ct.replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask)
+    expected = torch.tensor([
+        [5, 6, 3, 4],
+        [1, 7, 1, 8]
+    ])
+    assert torch.equal(expected, replaced['input_ids'])
+
+
+def test_replace_trigger_tokens_no_triggers():
+    model_inputs = {
+        'input_ids': torch.tensor([
+            [1, 2, 3, 4],
+            [1, 1, 1, 0]
+        ])
+    }
+    trigger_ids = torch.tensor([[]], dtype=torch.long)
+    trigger_mask = torch.zeros(2, 4, dtype=torch.bool)
+    replaced = ct.replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask)
+    assert torch.equal(model_inputs['input_ids'], replaced['input_ids'])
+
+
+def test_replace_trigger_tokens_too_many_positions():
+    model_inputs = {
+        'input_ids': torch.tensor([
+            [1, 2, 3, 4],
+            [1, 1, 1, 0]
+        ])
+    }
+    trigger_ids = torch.tensor([[5, 6]])
+    trigger_mask = torch.tensor([
+            [True, True, True, False],
+            [False, True, False, True]
+    ])
+    replaced = ct.replace_trigger_tokens(model_inputs, trigger_ids, trigger_mask)
+    # Only the instance with too many trigger positions is left as is
+    expected = torch.tensor([
+        [1, 2, 3, 4],
+        [1, 5, 1, 6]
+    ])
+    assert torch.equal(expected, replaced['input_ids'])
+
+
+def test_get_label_scores():
+    predict_logits = torch.randn(2, 5)
+    label_ids = torch.tensor([
+        [1, 2],
+        [3, 0]
+    ])
+    # Label scores only differ from the label log-probabilities by the log-partition function.
+    expected = -ct.get_loss(predict_logits, label_ids) + torch.logsumexp(predict_logits, dim=-1)
+    assert torch.allclose(expected, ct.get_label_scores(predict_logits, label_ids))
+
+
+def test_accuracy_fn():
+    # Integer labels are used as token ids as-is, so no tokenizer is needed.
+    label_map = {'pos': 1, 'neg': 2}
+    accuracy_fn = ct.AccuracyFn(None, label_map, torch.device('cpu'))
+    predict_logits = torch.tensor([
+        [0.0, 3.0, 1.0, 0.0],
+        [0.0, 1.0, 3.0, 0.0]
+    ])
+    gold_label_ids = torch.tensor([[1], [1]])
+
+    correct = accuracy_fn(predict_logits, gold_label_ids)
+    assert torch.equal(torch.tensor([1.0, 0.0]), correct)
+
+    predictions = accuracy_fn.predict(predict_logits)
+    assert predictions == ['pos', 'neg']
+
+
+def test_score_triggers():
+    model_inputs = {
+        'input_ids': torch.tensor([
+            [1, 2, 3],
+            [4, 5, 6],
+            [7, 8, 9]
+        ])
+    }
+    labels = torch.tensor([[0], [2], [4]])
+    triggers = torch.tensor([
+        [1, 0],
+        [2, 3],
+        [0, 5],
+        [4, 4],
+        [6, 1]
+    ])
+
+    # Stub predictor whose "logits" mix each instance with the trigger it is paired with, so any
+    # misalignment between inputs, triggers and labels changes the scores.
+    def predictor(model_inputs, trigger_ids):
+        input_ids = model_inputs['input_ids'].float()
+        return torch.cat((input_ids * trigger_ids[:, :1], trigger_ids.float() ** 2), dim=-1)
+
+    def evaluation_fn(predict_logits, labels):
+        return predict_logits.gather(-1, labels).squeeze(-1) * predict_logits.sum(dim=-1)
+
+    # Score each trigger one at a time, without any tiling
+    expected = []
+    for trigger in triggers:
+        predict_logits = predictor(model_inputs, trigger.expand(labels.size(0), -1))
+        expected.append(evaluation_fn(predict_logits, labels).sum())
+    expected = torch.stack(expected)
+
+    # A chunk size of 2 does not divide the number of triggers, so the last chunk is smaller
+    for chunk_size in (1, 2, 5):
+        scores = ct.score_triggers(predictor, evaluation_fn, model_inputs, labels, triggers, chunk_size)
+        assert torch.equal(expected, scores)
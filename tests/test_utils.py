@@ -1,8 +1,12 @@
+import os
+import tempfile
 from unittest import TestCase
 
 import torch
 from torch.utils.data import DataLoader
-from transformers import AutoConfig, AutoTokenizer
+from transformers import (
+    AutoConfig, AutoTokenizer, BertConfig, BertForSequenceClassification, WEIGHTS_NAME
+)
 
 import autoprompt.utils as utils
 
@@ -24,6 +28,20 @@ class TestEncodeLabel(TestCase):
         assert torch.equal(output, expected_output)
 
 
+class TestRemoveDropout(TestCase):
+
+    def test_remove_dropout(self):
+        model = torch.nn.Sequential(
+            torch.nn.Linear(2, 2),
+            torch.nn.Dropout(0.1),
+            torch.nn.Sequential(torch.nn.Dropout(0.1), torch.nn.Linear(2, 2)),
+        )
+        utils.remove_dropout(model)
+        assert not any(isinstance(m, torch.nn.Dropout) for m in model.modules())
+        assert isinstance(model[1], torch.nn.Identity)
+        assert isinstance(model[2][0], torch.nn.Identity)
+
+
 class TestTriggerTemplatizer(TestCase):
     def setUp(self):
         self.default_template = '[T] [T] {arbitrary} [T] {fields} [P]'
@@ -157,3 +175,73 @@ class TestCollator(TestCase):
             [False, False, False, False, False, False, False, True],
         ])
         assert torch.equal(expected_predict_mask, model_inputs['predict_mask'])
+
+    def test_pad_to_multiple_of(self):
+        collator = utils.Collator(pad_token_id=3, pad_to_multiple_of=4)
+        features = [
+            ({'input_ids': torch.tensor([[1, 2, 1, 2, 1]]),
+              'predict_mask': torch.tensor([[False, False, False, False, True]])},
+             torch.tensor([[5]])),
+            ({'input_ids': torch.tensor([[1, 2]]),
+              'predict_mask': torch.tensor([[False, True]])},
+             torch.tensor([[6]])),
+        ]
+        model_inputs, labels = collator(features)
+
+        expected_input_ids = torch.tensor([
+            [1, 2, 1, 2, 1, 3, 3, 3],
+            [1, 2, 3, 3, 3, 3, 3, 3],
+        ])
+        assert torch.equal(expected_input_ids, model_inputs['input_ids'])
+
+        expected_predict_mask = torch.tensor([
+            [False, False, False, False, True, False, False, False],
+            [False, True, False, False, False, False, False, False],
+        ])
+        assert torch.equal(expected_predict_mask, model_inputs['predict_mask'])
+
+        # Labels are not sequences, so they should not be padded
+        assert torch.equal(torch.tensor([[5], [6]]), labels)
+
+
+def _tiny_bert():
+    config = BertConfig(
+        vocab_size=10,
+        hidden_size=4,
+        num_hidden_layers=1,
+        num_attention_heads=1,
+        intermediate_size=4
+    )
+    return BertForSequenceClassification(config)
+
+
+class TestAsyncCheckpointer(TestCase):
+
+    def test_save(self):
+        model = _tiny_bert()
+        expected_state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+        checkpointer = utils.AsyncCheckpointer()
+        with tempfile.TemporaryDirectory() as save_directory:
+            checkpointer.save(model, save_directory)
+            # Updates made after `save` is called should not end up in the checkpoint
+            with torch.no_grad():
+                for p in model.parameters():
+                    p.add_(1.0)
+            checkpointer.close()
+
+            state_dict = torch.load(os.path.join(save_directory, WEIGHTS_NAME))
+            assert state_dict.keys() == expected_state_dict.keys()
+            for k, v in expected_state_dict.items():
+                assert torch.equal(v, state_dict[k])
+
+            # The checkpoint should be loadable with `from_pretrained`
+            BertForSequenceClassification.from_pretrained(save_directory)
+
+    def test_close_surfaces_errors(self):
+        checkpointer = utils.AsyncCheckpointer()
+        with tempfile.TemporaryDirectory() as save_directory:
+            # Occupy the weights path with a directory, so writing the weights fails
+            os.mkdir(os.path.join(save_directory, WEIGHTS_NAME))
+            checkpointer.save(_tiny_bert(), save_directory)
+            with self.assertRaises((OSError, RuntimeError)):
+                checkpointer.close()